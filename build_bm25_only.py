@@ -3,59 +3,49 @@
 只构建BM25关键词索引的简化脚本
 """
 
-import json
-import pickle
+import orjson
 import os
 import sys
-import jieba
-from rank_bm25 import BM25Okapi
+import bm25s
+from bm25s.tokenization import Tokenized
+
+from text_tokenizer import create_summary, tokenize, tokenize_corpus
+from post_store import POSTS_STORE_PATH, save_post_store
 
 def build_bm25_index():
     """只构建BM25关键词索引"""
     print("开始构建BM25关键词索引...")
     
-    # 1. 加载数据
-    data_file = "data/posts_data.json"
+    # 1. 加载数据 (与 build_index.py 读同一份清洗后的数据，二者写出的帖子原文库才一致)
+    data_file = "data/posts_data_cleaned.json"
     if not os.path.exists(data_file):
         print(f"数据文件不存在: {data_file}")
+        print("请先运行 clean_data.py 进行数据清洗！")
         return False
     
-    with open(data_file, 'r', encoding='utf-8') as f:
-        posts = json.load(f)
+    with open(data_file, 'rb') as f:
+        posts = orjson.loads(f.read())
     
     print(f"成功加载 {len(posts)} 条帖子数据")
     
     # 2. 准备文档列表
     documents = []
-    doc_mapping = []
-    
-    for i, post in enumerate(posts):
-        content = post.get('content', '')
-        title = post.get('title', '')
-        
-        # 合并标题和内容作为文档
-        document = f"{title} {content}"
-        
-        # 使用jieba分词
-        tokens = list(jieba.cut_for_search(document))
-        
-        # 过滤停用词和短词
-        filtered_tokens = []
-        for token in tokens:
-            token = token.strip()
-            if len(token) > 1 and not token.isspace():
-                filtered_tokens.append(token)
-        
+    doc_mapping = []  # 只存帖子ID，原文存到 posts_by_id 中按 ID 查阅
+    
+    # 分词 (与 build_index.py 共用 data/tokens.jsonl.zst 缓存，未变化的帖子跳过 jieba)
+    post_ids = [str(post.get('id', i)) for i, post in enumerate(posts)]
+    token_ids, vocab = tokenize_corpus(posts, post_ids)
+    
+    # 帖子原文库由向量检索共用，必须收录全部帖子 (与 build_index.py 写法一致)，不能只收有分词结果的
+    posts_by_id = {
+        pid: {**post, 'summary': create_summary(post.get('content', ''))}
+        for pid, post in zip(post_ids, posts)
+    }
+    
+    for post_id, filtered_tokens in zip(post_ids, token_ids):
         if filtered_tokens:
             documents.append(filtered_tokens)
-            doc_mapping.append({
-                'id': post.get('id', str(i)),
-                'title': title,
-                'content': content,
-                'author': post.get('author', ''),
-                'url': post.get('url', ''),
-                'timestamp': post.get('timestamp', '')
-            })
+            doc_mapping.append({'id': post_id})
     
     if not documents:
         print("没有有效的文档可用于构建BM25索引")
@@ -63,37 +53,38 @@ def build_bm25_index():
     
     print(f"准备构建BM25模型，文档数: {len(documents)}")
     
-    # 3. 构建BM25模型
-    bm25 = BM25Okapi(documents)
-    
-    # 4. 保存索引和映射
-    index_data = {
-        'bm25_model': bm25,
-        'doc_mapping': doc_mapping,
-        'document_count': len(documents)
-    }
+    # 3. 构建BM25模型 (bm25s 稀疏矩阵索引，numba 后端打分)
+    bm25 = bm25s.BM25(backend="numba")
+    bm25.index(Tokenized(ids=documents, vocab=vocab), show_progress=False)
     
-    output_path = "data/bm25_index.pkl"
+    # 4. 保存索引和映射 (bm25s 原生格式，语料中只存帖子ID)
+    output_path = "data/bm25_index"
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    with open(output_path, 'wb') as f:
-        pickle.dump(index_data, f)
+    bm25.save(output_path, corpus=doc_mapping, show_progress=False)
+    
+    save_post_store(posts_by_id, POSTS_STORE_PATH)
     
     print(f"关键词索引构建完成！已保存到: {output_path}")
+    print(f"帖子原文已保存到: {POSTS_STORE_PATH}")
     print(f"文档总数: {len(documents)}")
     
     # 5. 测试索引
     print("\n测试索引功能...")
+    bm25.activate_numba_scorer()
     test_queries = ["校园", "学习", "考试"]
+    k = min(3, len(documents))
     for query in test_queries:
-        tokenized_query = list(jieba.cut_for_search(query))
-        scores = bm25.get_scores(tokenized_query)
-        if len(scores) > 0:
-            top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:3]
+        tokenized_query = tokenize(query)
+        # top-k 由 numba 编译的选择算法完成，无需对全部分数排序
+        top_indices, scores = bm25.retrieve(
+            [tokenized_query], k=k, backend_selection="numba", show_progress=False
+        )
+        if scores[0][0] > 0:
             print(f"查询 '{query}':")
-            for idx in top_indices:
-                if scores[idx] > 0:
-                    print(f"  - {doc_mapping[idx]['title'][:30]}... (分数: {scores[idx]:.4f})")
+            for idx, score in zip(top_indices[0], scores[0]):
+                if score > 0:
+                    print(f"  - {posts_by_id[doc_mapping[idx]['id']]['title'][:30]}... (分数: {score:.4f})")
         else:
             print(f"查询 '{query}': 无匹配结果")
     
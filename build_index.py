@@ -5,26 +5,46 @@
 功能：读取JSON数据，分别构建"向量索引"和"关键词索引"
 """
 
-import json
-import pickle
 import os
 import sys
-import math
-from typing import List, Dict, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple
 from tqdm import tqdm # 导入进度条库
+import numpy as np
 
 # 导入必要的库
 try:
-    import jieba
-    from rank_bm25 import BM25Okapi
+    import orjson
+    import bm25s
+    from bm25s.tokenization import Tokenized
+    import torch
     from sentence_transformers import SentenceTransformer
     import chromadb
     from chromadb.config import Settings
 except ImportError as e:
     print(f"导入库失败: {e}")
-    print("请先安装依赖: pip install chromadb sentence-transformers rank_bm25 jieba tqdm")
+    print("请先安装依赖: pip install chromadb sentence-transformers bm25s numba jieba orjson zstandard tqdm")
     sys.exit(1)
 
+try:
+    import hnswlib # 可选：额外导出一份内存 HNSW 索引，服务端可绕过 ChromaDB 直接检索
+except ImportError:
+    hnswlib = None
+
+from text_tokenizer import content_hash, create_summary, tokenize_corpus
+from post_store import POSTS_STORE_PATH, save_post_store
+
+
+def _build_doc(post: Dict[str, Any]) -> str:
+    """组合标题和内容作为向量化的文本，让语义更丰富"""
+    title = post.get('title', '无标题')
+    content = post.get('content', '')
+    # 如果正文太短，重复一下标题增强权重
+    doc_text = f"{title}\n{content}" if len(content) > 5 else f"{title}\n{title}"
+    # 长度截断 (Chroma 存储限制；送入模型前还会按 token 数再截断)
+    return doc_text[:8000]
+
 
 class IndexBuilder:
     # 【修改点1】默认路径改为 cleaned 版本
@@ -35,12 +55,23 @@ class IndexBuilder:
         self.chroma_db_path = chroma_db_path
         self.embedding_model_name = embedding_model_name
         
+        # 向量缓存：结构化 .npy，每行 (缓存键, 向量)；键与向量同在一个文件里，整体原子替换，不会错配
+        self.embedding_cache_path = "data/embeddings.npy"
+        # 索引清单：{帖子ID: 内容哈希}，记录向量库中每条帖子的当前版本
+        self.manifest_path = "data/manifest.json"
+        # 帖子原文：{帖子ID: 帖子}，BM25 索引只存 ID，检索时按 ID 回查
+        self.posts_store_path = POSTS_STORE_PATH
+        # hnswlib 索引：标签 i 对应 ids 文件中第 i 个帖子ID
+        self.hnsw_index_path = "data/hnsw.bin"
+        self.hnsw_ids_path = "data/hnsw_ids.json"
+        
         os.makedirs(os.path.dirname(data_path), exist_ok=True)
         os.makedirs(chroma_db_path, exist_ok=True)
         
         self.embedding_model = None
         self.chroma_client = None
         self.collection = None
+        self.device = "cpu"
         
     def load_data(self) -> List[Dict[str, Any]]:
         """加载JSON数据"""
@@ -50,8 +81,8 @@ class IndexBuilder:
             return []
         
         try:
-            with open(self.data_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(self.data_path, 'rb') as f:
+                data = orjson.loads(f.read())
             print(f"📚 成功加载 {len(data)} 条帖子数据")
             return data
         except Exception as e:
@@ -61,16 +92,22 @@ class IndexBuilder:
     def initialize_models(self):
         """初始化嵌入模型和ChromaDB客户端"""
         print("⏳ 正在初始化嵌入模型 (首次运行会自动下载，约400MB)...")
+        # 自动选择推理设备：CUDA > Apple MPS > CPU
+        if torch.cuda.is_available():
+            self.device = "cuda"
+        elif torch.backends.mps.is_available():
+            self.device = "mps"
+        else:
+            self.device = "cpu"
+        print(f"🖥️ 推理设备: {self.device}")
+        
         try:
-            self.embedding_model = SentenceTransformer(
-                self.embedding_model_name,
-                device='cpu' # 笔记本使用 CPU 即可
-            )
+            self.embedding_model = self._load_embedding_model(self.embedding_model_name)
             print(f"✅ 嵌入模型加载成功: {self.embedding_model_name}")
         except Exception as e:
             print(f"⚠️ 加载中文模型失败: {e}")
             print("🔄 尝试使用备用模型...")
-            self.embedding_model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2", device='cpu')
+            self.embedding_model = self._load_embedding_model("paraphrase-multilingual-MiniLM-L12-v2")
         
         print("⏳ 正在初始化 ChromaDB...")
         try:
@@ -80,76 +117,308 @@ class IndexBuilder:
             print(f"❌ 初始化 ChromaDB 失败: {e}")
             raise
     
+    def _load_embedding_model(self, model_name: str) -> SentenceTransformer:
+        """按设备加载模型：CPU 上优先走 ONNX Runtime，GPU 上走 PyTorch"""
+        if self.device == "cpu":
+            try:
+                # 首次运行会自动导出 ONNX 图并缓存，encode 接口完全不变
+                return SentenceTransformer(
+                    model_name,
+                    device="cpu",
+                    backend="onnx",
+                    model_kwargs={"provider": "CPUExecutionProvider"}
+                )
+            except Exception as e:
+                print(f"⚠️ ONNX 后端不可用，回退到 PyTorch: {e}")
+        
+        # CUDA 上使用半精度，显存带宽和计算量减半
+        model_kwargs = {"torch_dtype": torch.float16} if self.device == "cuda" else None
+        return SentenceTransformer(model_name, device=self.device, model_kwargs=model_kwargs)
+    
+    def _target_devices(self) -> List[str]:
+        """多卡时返回多进程编码池的设备列表，否则返回空列表 (单进程编码)"""
+        # CPU 上 torch 已经用满所有核心 (intra-op 多线程)，再开多进程只会互相争抢
+        if self.device == "cuda" and torch.cuda.device_count() > 1:
+            return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        return []
+    
+    def _truncate_for_embedding(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        """
+        按模型的最大 token 数截断文本，超出部分模型本来也会丢弃，提前截掉可省去重复分词
+        
+        Returns:
+            (截断后的文本, 每条文本的 token 数)
+        """
+        tokenizer = self.embedding_model.tokenizer
+        if not getattr(tokenizer, 'is_fast', False):
+            # 慢速分词器没有 offset_mapping，退回按字符长度近似
+            return texts, [len(t) for t in texts]
+        
+        max_length = (self.embedding_model.max_seq_length or 512) - 2 # 留出 [CLS] [SEP]
+        truncated, lengths = [], []
+        for s in range(0, len(texts), 1024):
+            chunk = texts[s:s + 1024]
+            encoded = tokenizer(
+                chunk,
+                add_special_tokens=False,
+                truncation=True,
+                max_length=max_length,
+                return_offsets_mapping=True
+            )
+            for text, offsets in zip(chunk, encoded['offset_mapping']):
+                # 最后一个保留 token 的结束位置就是截断点
+                truncated.append(text[:offsets[-1][1]] if offsets else text)
+                lengths.append(len(offsets))
+        return truncated, lengths
+    
+    def _embedding_cache_keys(self, hashes: List[str]) -> List[bytes]:
+        """缓存键：模型名与内容哈希合在一起取指纹，换了模型旧向量自然失效"""
+        prefix = self.embedding_model_name + "\n"
+        return [content_hash(prefix + h).encode('ascii') for h in hashes]
+    
+    def _load_embedding_cache(self, dim: int):
+        """以只读内存映射方式打开上次的向量缓存，返回 (向量矩阵, {缓存键: 行号})"""
+        if not os.path.exists(self.embedding_cache_path):
+            return None, {}
+        
+        try:
+            cache = np.load(self.embedding_cache_path, mmap_mode='r')
+            # 旧格式 (纯向量矩阵) 或维度不同时，缓存作废
+            if cache.dtype.names != ('key', 'emb') or cache.dtype['emb'].shape != (dim,):
+                return None, {}
+            return cache['emb'], {key: row for row, key in enumerate(cache['key'].tolist())}
+        except Exception as e:
+            print(f"⚠️ 读取向量缓存失败，将全部重新编码: {e}")
+            return None, {}
+    
+    def _save_embedding_cache(self, all_emb: np.ndarray, cache_keys: List[bytes]):
+        """保存本次全部向量，下次构建时未变化的帖子无需再跑模型"""
+        records = np.empty(len(cache_keys), dtype=[('key', 'S32'), ('emb', np.float32, (all_emb.shape[1],))])
+        records['key'] = cache_keys
+        records['emb'] = all_emb
+        # 先写临时文件再替换，避免中途失败留下损坏的缓存
+        tmp_path = self.embedding_cache_path + ".tmp.npy"
+        np.save(tmp_path, records)
+        os.replace(tmp_path, self.embedding_cache_path)
+    
+    def _collection_metadata(self, num_docs: int) -> Dict[str, Any]:
+        """
+        按语料规模分档选择 HNSW 参数：
+        规模越大，图的连接数 (M) 和搜索宽度 (ef) 越大，以维持召回率
+        """
+        if num_docs < 10_000:
+            m, construction_ef, search_ef = 16, 100, 64
+        elif num_docs < 100_000:
+            m, construction_ef, search_ef = 16, 200, 100
+        else:
+            m, construction_ef, search_ef = 24, 200, 128
+        return {
+            "description": "UESTC Forum Posts",
+            "hnsw:space": "cosine", # 向量已归一化，余弦距离可直接还原为相似度
+            "hnsw:M": m,
+            "hnsw:construction_ef": construction_ef,
+            "hnsw:search_ef": search_ef
+        }
+    
+    def _save_hnsw_index(self, ids: List[str], all_emb: np.ndarray):
+        """
+        用全部向量构建 hnswlib 索引 (参数与 Chroma 同档)，服务端整块载入内存后直接检索，
+        省去 ChromaDB 每次查询的 SQLite 与序列化开销；全量构建是多线程的，不做增量
+        """
+        if hnswlib is None:
+            print("⚠️ 未安装 hnswlib，跳过内存 HNSW 索引 (服务端将使用 ChromaDB)")
+            return
+        
+        params = self._collection_metadata(len(ids))
+        index = hnswlib.Index(space='cosine', dim=all_emb.shape[1])
+        index.init_index(
+            max_elements=len(ids),
+            M=params["hnsw:M"],
+            ef_construction=params["hnsw:construction_ef"]
+        )
+        index.add_items(all_emb, np.arange(len(ids)))
+        
+        # 先写临时文件再替换，服务端不会读到写了一半的索引
+        tmp_path = self.hnsw_index_path + ".tmp"
+        index.save_index(tmp_path)
+        tmp_ids_path = self.hnsw_ids_path + ".tmp"
+        with open(tmp_ids_path, 'wb') as f:
+            f.write(orjson.dumps({
+                'dim': int(all_emb.shape[1]),
+                'search_ef': params["hnsw:search_ef"],
+                'ids': ids
+            }))
+        os.replace(tmp_path, self.hnsw_index_path)
+        os.replace(tmp_ids_path, self.hnsw_ids_path)
+        print(f"✅ HNSW 索引已保存: {self.hnsw_index_path}")
+    
+    def _load_manifest(self) -> Dict[str, str]:
+        """读取索引清单 {帖子ID: 内容哈希}"""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except Exception as e:
+            print(f"⚠️ 读取索引清单失败: {e}")
+            return {}
+    
+    def _save_manifest(self, manifest: Dict[str, str]):
+        with open(self.manifest_path, 'wb') as f:
+            f.write(orjson.dumps(manifest))
+    
     def build_vector_index(self, posts: List[Dict[str, Any]]) -> bool:
         """构建向量索引 (ChromaDB) - 支持分批处理"""
         if not posts: return False
         
         try:
-            # 重置 Collection
-            try:
-                self.chroma_client.delete_collection("forum_posts")
-            except:
-                pass
-            
-            self.collection = self.chroma_client.create_collection(
+            # 增量更新：保留已有 Collection，只写入变化的帖子
+            collection_metadata = self._collection_metadata(len(posts))
+            # 向量一律由本脚本的模型生成后显式传入，不让 Chroma 挂上默认的 ONNX MiniLM 嵌入函数
+            self.collection = self.chroma_client.get_or_create_collection(
                 name="forum_posts",
-                metadata={"description": "UESTC Forum Posts"}
+                metadata=collection_metadata,
+                embedding_function=None
             )
+            manifest = self._load_manifest()
+            reset_reason = None
+            if self.collection.count() != len(manifest):
+                # 清单与向量库对不上 (首次构建或上次中途失败)
+                reset_reason = "索引清单与向量库不一致"
+            elif self.collection.metadata != collection_metadata:
+                # HNSW 参数只能在创建时指定，语料规模跨档后需要重建图 (向量走缓存，无需重新编码)
+                reset_reason = "HNSW 参数已变化"
+            if reset_reason:
+                print(f"⚠️ {reset_reason}，将全量重建")
+                self.chroma_client.delete_collection("forum_posts")
+                self.collection = self.chroma_client.create_collection(
+                    name="forum_posts",
+                    metadata=collection_metadata,
+                    embedding_function=None
+                )
+                manifest = {}
             
             # 准备数据
             print("🔄 正在准备向量数据...")
-            ids = []
-            documents = []
-            metadatas = []
-            
-            for i, post in enumerate(posts):
-                # 确保 ID 是字符串
-                post_id = str(post.get('id', i)) 
-                
-                # 组合标题和内容，让语义更丰富
-                title = post.get('title', '无标题')
-                content = post.get('content', '')
-                # 如果正文太短，重复一下标题增强权重
-                doc_text = f"{title}\n{content}" if len(content) > 5 else f"{title}\n{title}"
-                
-                # 长度截断 (Chroma 限制)
-                if len(doc_text) > 8000: doc_text = doc_text[:8000]
-                
-                ids.append(post_id)
-                documents.append(doc_text)
-                metadatas.append({
-                    'title': title,
+            # 一次列表推导生成一列，避免逐条 append
+            ids = [str(post.get('id', i)) for i, post in enumerate(posts)] # 确保 ID 是字符串
+            documents = [_build_doc(post) for post in posts]
+            metadatas = [
+                {
+                    'title': post.get('title', '无标题'),
                     'author': post.get('author', '未知'),
                     'url': post.get('url', ''),
                     'timestamp': str(post.get('timestamp', '')),
+                    'summary': create_summary(post.get('content', '')),
                     'id': post_id
-                })
+                }
+                for post, post_id in zip(posts, ids)
+            ]
             
-            # 【修改点2】分批写入 (Batch Processing)
-            BATCH_SIZE = 64
-            total_batches = math.ceil(len(ids) / BATCH_SIZE)
+            # 【修改点2】分批编码 (Batch Processing)
+            # GPU 上的限制是显存而非耗时，可以用更大的批次
+            BATCH_SIZE = 128 if self.device == "cpu" else 256
             
-            print(f"🚀 开始向量化并存入数据库 (共 {len(ids)} 条，分 {total_batches} 批)...")
+            # 所有向量写入一块连续的 float32 数组，全程不转成 Python 列表
+            dim = self.embedding_model.get_sentence_embedding_dimension()
+            all_emb = np.empty((len(ids), dim), dtype=np.float32)
             
-            for i in tqdm(range(0, len(ids), BATCH_SIZE), desc="向量化进度"):
-                end = i + BATCH_SIZE
-                batch_ids = ids[i:end]
-                batch_docs = documents[i:end]
-                batch_metas = metadatas[i:end]
-                
-                # 生成向量
-                batch_embeddings = self.embedding_model.encode(
-                    batch_docs, 
-                    normalize_embeddings=True # 归一化向量，这对余弦相似度很重要
-                ).tolist()
+            # 内容没变的帖子直接从缓存取向量，只编码新增/修改过的
+            hashes = [content_hash(d) for d in documents]
+            cache_keys = self._embedding_cache_keys(hashes)
+            cache, cache_rows = self._load_embedding_cache(dim)
+            hit = np.array([key in cache_rows for key in cache_keys], dtype=bool)
+            if hit.any():
+                all_emb[hit] = cache[[cache_rows[key] for key, ok in zip(cache_keys, hit) if ok]]
+            del cache # 释放内存映射，稍后要覆盖写同一个文件
+            missing = np.flatnonzero(~hit)
+            
+            # 按模型的 token 上限截断待编码文本 (Chroma 中仍存完整文本)，顺便得到精确的 token 数
+            embed_texts = list(documents)
+            token_lens = np.zeros(len(ids), dtype=np.int64)
+            if len(missing) > 0:
+                truncated, lens = self._truncate_for_embedding([documents[j] for j in missing])
+                for j, text in zip(missing, truncated):
+                    embed_texts[j] = text
+                token_lens[missing] = lens
+            
+            # 对比清单：正文或元数据有变化的帖子需要写入，已消失的帖子需要删除
+            record_hashes = [
+                content_hash(h + orjson.dumps(m, option=orjson.OPT_SORT_KEYS).decode('utf-8'))
+                for h, m in zip(hashes, metadatas)
+            ]
+            changed = np.array([manifest.get(pid) != rh for pid, rh in zip(ids, record_hashes)], dtype=bool)
+            removed = list(manifest.keys() - set(ids))
+            
+            print(f"♻️ 复用缓存向量 {int(hit.sum())} 条，需编码 {len(missing)} 条")
+            print(f"🚀 需写入 {int(changed.sum())} 条，删除 {len(removed)} 条 (共 {len(ids)} 条)...")
+            
+            # 多卡时先用多进程池把全部文档编码完，再分批写入
+            target_devices = self._target_devices()
+            if target_devices and len(missing) > 0:
+                print(f"🔥 多进程编码池: {target_devices}")
+                pool = self.embedding_model.start_multi_process_pool(target_devices=target_devices)
+                try:
+                    all_emb[missing] = self.embedding_model.encode_multi_process(
+                        [embed_texts[j] for j in missing],
+                        pool,
+                        batch_size=BATCH_SIZE,
+                        normalize_embeddings=True
+                    )
+                finally:
+                    self.embedding_model.stop_multi_process_pool(pool)
+            
+            # 需要处理的帖子：缺向量的要编码，有变化的要写入
+            # 按 token 数排序后再分批 (Smart Batching)：每批只需 padding 到本批最长的文本
+            # 编码是计算密集，写 Chroma 是 I/O，交给后台线程写入，主线程继续编码下一批
+            work = np.flatnonzero(~hit | changed)
+            work = work[np.argsort(token_lens[work], kind='stable')]
+            # 每次 upsert 都是一次 SQLite 事务，按 Chroma 允许的最大批次写入，减少事务数
+            try:
+                write_batch = self.chroma_client.get_max_batch_size()
+            except Exception:
+                write_batch = 5461 # 旧版 Chroma 的默认上限
+            
+            MAX_IN_FLIGHT = 2
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as executor:
+                for i in tqdm(range(0, len(work), write_batch), desc="向量化进度"):
+                    batch = work[i:i + write_batch]
+                    
+                    todo = batch[~hit[batch]]
+                    if not target_devices and len(todo) > 0:
+                        # 生成向量 (模型内部按 BATCH_SIZE 分小批前向)
+                        all_emb[todo] = self.embedding_model.encode(
+                            [embed_texts[j] for j in todo], 
+                            batch_size=BATCH_SIZE,
+                            convert_to_numpy=True,
+                            normalize_embeddings=True # 归一化向量，这对余弦相似度很重要
+                        )
+                    
+                    # 写入 Chroma (upsert 幂等；all_emb[up] 是副本，后续编码不会改到它)
+                    up = batch[changed[batch]]
+                    if len(up) > 0:
+                        # 最多 MAX_IN_FLIGHT 批在写，先等最早的一批写完，控制内存占用
+                        if len(pending) >= MAX_IN_FLIGHT:
+                            pending.popleft().result()
+                        pending.append(executor.submit(
+                            self.collection.upsert,
+                            ids=[ids[j] for j in up],
+                            embeddings=all_emb[up],
+                            documents=[documents[j] for j in up],
+                            metadatas=[metadatas[j] for j in up]
+                        ))
                 
-                # 写入 Chroma
-                self.collection.add(
-                    ids=batch_ids,
-                    embeddings=batch_embeddings,
-                    documents=batch_docs,
-                    metadatas=batch_metas
-                )
+                # 等待剩余写入完成 (result() 会抛出写入线程里的异常)
+                while pending:
+                    pending.popleft().result()
+            
+            for i in range(0, len(removed), write_batch):
+                self.collection.delete(ids=removed[i:i + write_batch])
+            
+            self._save_embedding_cache(all_emb, cache_keys)
+            self._save_manifest(dict(zip(ids, record_hashes)))
+            self._save_hnsw_index(ids, all_emb)
             
             print(f"✅ 向量索引构建完成！")
             return True
@@ -167,37 +436,29 @@ class IndexBuilder:
         try:
             print("🏗️ 正在构建关键词索引 (BM25)...")
             
-            tokenized_corpus = []
-            doc_mapping = [] 
+            # 分词 (未变化的帖子直接复用 data/tokens.jsonl.zst 中的缓存)
+            post_ids = [str(post.get('id', i)) for i, post in enumerate(posts)]
+            token_ids, vocab = tokenize_corpus(posts, post_ids)
             
-            # 使用 tqdm 显示进度
-            for post in tqdm(posts, desc="分词进度"):
-                # 组合标题和内容
-                text = f"{post.get('title', '')} {post.get('content', '')}"
-                
-                # jieba 分词
-                tokens = jieba.lcut_for_search(text)
-                
-                # 简单的停用词过滤 (过滤掉标点和单字)
-                filtered_tokens = [t for t in tokens if len(t.strip()) > 1]
-                
-                tokenized_corpus.append(filtered_tokens)
-                doc_mapping.append(post) # 存下原始数据，方便检索时查阅
+            # 语料只存帖子ID，原文另存一份按 ID 查阅，避免索引里重复一份全文
+            doc_mapping = [{'id': pid} for pid in post_ids]
             
-            # 构建模型
-            bm25 = BM25Okapi(tokenized_corpus)
+            # 构建模型 (bm25s 稀疏矩阵 + numba 打分，替代 rank_bm25 的纯 Python 实现)
+            bm25 = bm25s.BM25(backend="numba")
+            bm25.index(Tokenized(ids=token_ids, vocab=vocab), show_progress=False)
             
-            # 保存
-            index_data = {
-                'bm25_model': bm25,
-                'doc_mapping': doc_mapping
-            }
+            # 保存 (bm25s 原生格式：稀疏矩阵存为 .npy，服务端可直接内存映射加载)
+            output_path = "data/bm25_index"
+            bm25.save(output_path, corpus=doc_mapping, show_progress=False)
             
-            output_path = "data/bm25_index.pkl"
-            with open(output_path, 'wb') as f:
-                pickle.dump(index_data, f)
+            # 摘要在这里生成一次，检索时直接读取
+            save_post_store({
+                pid: {**post, 'summary': create_summary(post.get('content', ''))}
+                for pid, post in zip(post_ids, posts)
+            }, self.posts_store_path)
             
             print(f"✅ 关键词索引已保存: {output_path}")
+            print(f"✅ 帖子原文已保存: {self.posts_store_path}")
             return True
             
         except Exception as e:
@@ -217,7 +478,7 @@ class IndexBuilder:
         if v_ok and k_ok:
             print("\n🎉🎉🎉 所有索引构建成功！")
             print(f"📂 向量库存放于: {self.chroma_db_path}")
-            print(f"📂 BM25 存放于: data/bm25_index.pkl")
+            print(f"📂 BM25 存放于: data/bm25_index/")
         else:
             print("\n⚠️ 即使部分失败，您可能仍可运行搜索，但功能受限。")
 
@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests
-import json
+import asyncio
+import aiohttp
+import orjson
 import time
 import os
 import re
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+
+# 预编译正则：Markdown 图片/表情代码 (如 ![1155](s)) 与 HTML 标签合并为一次扫描
+_RE_MARKUP = re.compile(r'!\[.*?\]\(.*?\)|<[^>]+>')
+
+# 遇到限流或服务端错误时退避重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+
+class RateLimiter:
+    """令牌桶限速 (协程安全)：限制的是全局请求速率，而不是在每次请求后固定 sleep"""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class ForumCrawlerFinal:
-    def __init__(self, forum_id: int, cookie: str, auth_token: str, max_pages: int = 10):
+    def __init__(self, forum_id: int, cookie: str, auth_token: str, max_pages: int = 10,
+                 rate_limit: float = 10.0, concurrency: int = 16):
         self.forum_id = forum_id
         self.max_pages = max_pages
+        # 每秒最多发出 rate_limit 个请求，同时在途的详情请求不超过 concurrency 个
+        self.rate_limit = rate_limit
+        self.concurrency = concurrency
+        self.rate_limiter = None
+        self.semaphore = None
+        self.session: Optional[aiohttp.ClientSession] = None
         
         # 1. 列表 API (用于获取帖子清单)
         self.list_api_url = "https://bbs.uestc.edu.cn/_/thread/list"
@@ -18,17 +54,32 @@ class ForumCrawlerFinal:
         # 2. 详情 API (根据你提供的准确 URL 修改)
         self.detail_api_url = "https://bbs.uestc.edu.cn/_/post/list"
         
-        self.session = requests.Session()
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
             'Referer': f'https://bbs.uestc.edu.cn/forum/{forum_id}',
             'Accept': 'application/json, text/plain, */*',
+            # JSON 压缩率很高；不声明 br，aiohttp 只有装了 brotli 才能解码
+            'Accept-Encoding': 'gzip, deflate',
             'Cookie': cookie,
             'Authorization': auth_token 
         }
-        self.session.headers.update(self.headers)
 
-    def fetch_post_list(self, page: int) -> List[Dict]:
+    async def _get_json(self, url: str, params: Dict) -> Tuple[int, Optional[Dict]]:
+        """限速 + 重试的 GET 请求，返回 (HTTP 状态码, 解析后的 JSON)"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.rate_limiter.acquire()
+            try:
+                async with self.session.get(url, params=params) as resp:
+                    if resp.status not in RETRY_STATUS or attempt == MAX_RETRIES:
+                        if resp.status != 200:
+                            return resp.status, None
+                        return resp.status, orjson.loads(await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+            await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+    async def fetch_post_list(self, page: int) -> List[Dict]:
         """获取帖子列表"""
         params = {
             'forum_id': self.forum_id,
@@ -37,12 +88,12 @@ class ForumCrawlerFinal:
             'forum_details': 1
         }
         try:
-            resp = self.session.get(self.list_api_url, params=params, timeout=10)
-            if resp.status_code == 401:
+            status, data = await self._get_json(self.list_api_url, params)
+            if status == 401:
                 print("❌ 列表 API 401 未授权！请更新 Token。")
                 return []
-            resp.raise_for_status()
-            data = resp.json()
+            if data is None:
+                raise RuntimeError(f"HTTP {status}")
             # 兼容不同的返回结构
             rows = data.get('data', {}).get('rows', [])
             if not rows:
@@ -52,7 +103,7 @@ class ForumCrawlerFinal:
             print(f"❌ 获取列表失败: {e}")
             return []
 
-    def fetch_post_detail(self, thread_id: int) -> str:
+    async def fetch_post_detail(self, thread_id: int) -> str:
         """
         【关键修改】使用 /_/post/list 获取详情全文
         """
@@ -64,14 +115,12 @@ class ForumCrawlerFinal:
         }
         
         try:
-            resp = self.session.get(self.detail_api_url, params=params, timeout=10)
+            status, data = await self._get_json(self.detail_api_url, params)
             
-            if resp.status_code != 200:
-                print(f"    ⚠️ 获取详情失败 HTTP {resp.status_code}")
+            if data is None:
+                print(f"    ⚠️ 获取详情失败 HTTP {status}")
                 return ""
             
-            data = resp.json()
-            
             # 解析 rows
             # 结构可能是 data['rows'] 或 data['data']['rows']，根据你提供的 JSON 是直接在 data 下？
             # 或者是 data -> rows。通常 API 返回是 {"code":0, "data": { "rows": [...] } }
@@ -107,73 +156,81 @@ class ForumCrawlerFinal:
         """清洗文本，处理你提供的示例中的格式"""
         if not raw_text: return ""
         
-        # 1. 处理图片/表情代码，例如 ![1155](s)
+        # 1+2. 处理图片/表情代码 (如 ![1155](s))，并去除 HTML 标签 (如果有)
         # 我们可以把它替换为空，或者替换为 [表情]
-        text = re.sub(r'!\[.*?\]\(.*?\)', '', raw_text)
-        
-        # 2. 去除 HTML 标签 (如果有)
-        text = re.sub(r'<[^>]+>', '', text)
+        text = _RE_MARKUP.sub('', raw_text)
         
         # 3. 处理转义字符
         text = text.replace('\n', ' ').replace('\r', '')
         
         return text.strip()
 
-    def crawl(self):
+    async def _fetch_detail_limited(self, thread_id: int) -> str:
+        """信号量限制同时在途的详情请求数"""
+        async with self.semaphore:
+            return await self.fetch_post_detail(thread_id)
+
+    async def crawl(self):
         all_data = []
         print(f"🚀 开始全量爬取 | Forum ID: {self.forum_id}")
-        print("💡 提示：爬取全文速度较慢，请耐心等待...")
+        print(f"💡 提示：详情页并发抓取 (并发 {self.concurrency}，限速 {self.rate_limit} 请求/秒)...")
 
-        for page in range(1, self.max_pages + 1):
-            rows = self.fetch_post_list(page)
-            if not rows:
-                print("⚠️ 本页无数据或已结束。")
-                break
-            
-            print(f"✅ 第 {page} 页: 发现 {len(rows)} 条帖子")
-            
-            for row in rows:
-                thread_id = row.get('thread_id')
-                title = row.get('subject')
-                author = row.get('author')
+        self.rate_limiter = RateLimiter(self.rate_limit)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=32)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout) as session:
+            self.session = session
+            for page in range(1, self.max_pages + 1):
+                rows = await self.fetch_post_list(page)
+                if not rows:
+                    print("⚠️ 本页无数据或已结束。")
+                    break
                 
-                # 1. 列表页自带的摘要 (作为备选)
-                summary = row.get('summary', '')
+                print(f"✅ 第 {page} 页: 发现 {len(rows)} 条帖子")
                 
-                # 2. 获取全文
-                # 稍微延时，避免并发过高被封
-                time.sleep(0.5) 
-                full_content = self.fetch_post_detail(thread_id)
+                # 2. 并发获取本页所有帖子的全文，结果顺序与 rows 一致
+                full_contents = await asyncio.gather(
+                    *[self._fetch_detail_limited(row.get('thread_id')) for row in rows]
+                )
                 
-                # 如果详情页没取到，就用摘要顶替
-                final_content = full_content if len(full_content) > len(summary) else summary
-
-                # 时间处理
-                try:
-                    ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(row.get('dateline', 0)))
-                except:
-                    ts = "未知时间"
-
-                item = {
-                    "id": str(thread_id),
-                    "title": title,
-                    "author": author,
-                    "timestamp": ts,
-                    "url": f"https://bbs.uestc.edu.cn/forum.php?mod=viewthread&tid={thread_id}",
-                    "content": final_content
-                }
-                all_data.append(item)
-                print(f"  -> {title[:15]}... (正文:{len(final_content)}字)")
-            
-            self.save_data(all_data)
+                for row, full_content in zip(rows, full_contents):
+                    thread_id = row.get('thread_id')
+                    title = row.get('subject')
+                    author = row.get('author')
+                    
+                    # 1. 列表页自带的摘要 (作为备选)
+                    summary = row.get('summary', '')
+                    
+                    # 如果详情页没取到，就用摘要顶替
+                    final_content = full_content if len(full_content) > len(summary) else summary
+
+                    # 时间处理
+                    try:
+                        ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(row.get('dateline', 0)))
+                    except:
+                        ts = "未知时间"
+
+                    item = {
+                        "id": str(thread_id),
+                        "title": title,
+                        "author": author,
+                        "timestamp": ts,
+                        "url": f"https://bbs.uestc.edu.cn/forum.php?mod=viewthread&tid={thread_id}",
+                        "content": final_content
+                    }
+                    all_data.append(item)
+                    print(f"  -> {title[:15]}... (正文:{len(final_content)}字)")
+                
+                self.save_data(all_data)
             
         print(f"\n🎉 爬取结束！共收集 {len(all_data)} 条数据。")
 
     def save_data(self, data):
         output_file = "data/posts_data.json"
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 def main():
     # ================= 配置区 =================
@@ -189,7 +246,7 @@ def main():
         return
 
     crawler = ForumCrawlerFinal(FORUM_ID, COOKIE, AUTH_TOKEN, max_pages=5)
-    crawler.crawl()
+    asyncio.run(crawler.crawl())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
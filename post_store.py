@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+帖子原文存储模块
+功能：帖子按行写入 JSONL，另存一份 {帖子ID: [偏移, 长度]} 索引；
+检索服务以内存映射方式打开，按 ID 随用随读，不必把全部原文加载进内存
+"""
+
+import os
+import mmap
+from typing import Dict, Any, Optional
+
+import orjson
+
+POSTS_STORE_PATH = "data/posts.jsonl"
+
+
+def _index_path(path: str) -> str:
+    return path + ".index.json"
+
+
+def save_post_store(posts_by_id: Dict[str, Dict[str, Any]], path: str = POSTS_STORE_PATH):
+    """写入帖子原文及其偏移索引 (先写临时文件再替换，服务端不会读到写了一半的文件)"""
+    offsets = {}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        for post_id, post in posts_by_id.items():
+            line = orjson.dumps(post)
+            offsets[post_id] = [f.tell(), len(line)]
+            f.write(line + b'\n')
+
+    tmp_index_path = _index_path(path) + ".tmp"
+    with open(tmp_index_path, 'wb') as f:
+        f.write(orjson.dumps(offsets))
+
+    os.replace(tmp_path, path)
+    os.replace(tmp_index_path, _index_path(path))
+
+
+class PostStore:
+    """只读的帖子原文存储，内存中只保留 ID -> 偏移 的索引"""
+
+    def __init__(self, path: str = POSTS_STORE_PATH):
+        with open(_index_path(path), 'rb') as f:
+            self._offsets = orjson.loads(f.read())
+
+        self._file = open(path, 'rb')
+        # 空文件无法 mmap
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets else None
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __contains__(self, post_id: str) -> bool:
+        return post_id in self._offsets
+
+    def get(self, post_id: str, default: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """按帖子ID读取原文，不存在时返回 default"""
+        entry = self._offsets.get(post_id)
+        if entry is None:
+            return default
+        start, length = entry
+        return orjson.loads(self._mm[start:start + length])
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
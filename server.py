@@ -9,17 +9,23 @@ import json
 import pickle
 import os
 import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 import numpy as np
 
 # 导入必要的库
 try:
-    import jieba
-    from rank_bm25 import BM25Okapi
-    from sentence_transformers import SentenceTransformer
+    import bm25s
+    import torch
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
     import chromadb
     from chromadb.config import Settings
     import uvicorn
@@ -28,6 +34,27 @@ except ImportError as e:
     print("请先安装依赖: pip install -r requirements.txt")
     sys.exit(1)
 
+try:
+    import hnswlib # 可选：直接在内存 HNSW 索引上检索，未安装时回退到 ChromaDB
+except ImportError:
+    hnswlib = None
+
+from text_tokenizer import initialize as initialize_tokenizer, tokenize
+from post_store import POSTS_STORE_PATH, PostStore
+
+# 日志级别由环境变量 LOG_LEVEL 控制 (默认 INFO)；逐条查询的日志为 DEBUG 级别，默认不输出
+logger = logging.getLogger("hybrid")
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+# 导入时即加载分词词典：用 gunicorn --preload 启动时模块只在主进程导入一次，
+# fork 出的各个 worker 直接继承已构建好的词典 (写时复制共享)，不必各自再加载一遍
+initialize_tokenizer()
+
 
 # 数据模型
 class SearchRequest(BaseModel):
@@ -39,6 +66,9 @@ class SearchRequest(BaseModel):
 
 class SearchResult(BaseModel):
     """搜索结果模型"""
+    # 只读模型；忽略检索结果里的附加字段 (vector_score 等)，可直接由结果字典校验生成
+    model_config = ConfigDict(frozen=True, extra='ignore')
+    
     id: str
     title: str
     content: str
@@ -51,6 +81,8 @@ class SearchResult(BaseModel):
 
 class SearchResponse(BaseModel):
     """搜索响应模型"""
+    model_config = ConfigDict(frozen=True, extra='ignore')
+    
     query: str
     total_results: int
     results: List[SearchResult]
@@ -62,192 +94,395 @@ class HybridSearchEngine:
     
     def __init__(self, 
                  chroma_db_path: str = "chroma_db",
-                 bm25_index_path: str = "data/bm25_index.pkl",
-                 embedding_model_name: str = "shibing624/text2vec-base-chinese"):
+                 bm25_index_path: str = "data/bm25_index",
+                 posts_store_path: str = POSTS_STORE_PATH,
+                 hnsw_index_path: str = "data/hnsw.bin",
+                 hnsw_ids_path: str = "data/hnsw_ids.json",
+                 embedding_model_name: str = "shibing624/text2vec-base-chinese",
+                 onnx_model_dir: str = "models"):
         """
         初始化搜索引擎
         
         Args:
             chroma_db_path: ChromaDB存储路径
-            bm25_index_path: BM25索引文件路径
+            bm25_index_path: BM25索引目录 (bm25s 格式)
+            posts_store_path: 帖子原文文件路径 (JSONL + ID 偏移索引)
+            hnsw_index_path: hnswlib 索引文件路径
+            hnsw_ids_path: hnswlib 标签 -> 帖子ID 映射文件路径
             embedding_model_name: 嵌入模型名称
+            onnx_model_dir: INT8 量化 ONNX 模型的缓存目录
         """
         self.chroma_db_path = chroma_db_path
         self.bm25_index_path = bm25_index_path
+        self.posts_store_path = posts_store_path
+        self.hnsw_index_path = hnsw_index_path
+        self.hnsw_ids_path = hnsw_ids_path
+        # 向量检索后端由环境变量 VECTOR_BACKEND 控制：hnswlib (默认，索引不可用时回退) 或 chroma
+        self.vector_backend = os.environ.get("VECTOR_BACKEND", "hnswlib").lower()
         self.embedding_model_name = embedding_model_name
+        self.onnx_model_dir = onnx_model_dir
+        self.embedding_backend = None # 'onnx' 或 'torch'
         
         # 初始化组件
         self.embedding_model = None
         self.chroma_client = None
         self.collection = None
+        self.hnsw_index = None
+        self.hnsw_ids = None
+        self.hnsw_search_ef = 64
         self.bm25_model = None
         self.bm25_doc_mapping = None
+        self.posts_by_id = None
+        self.bm25_legacy = False
+        
+        # 查询缓存：精确匹配 LRU + 语义缓存 (近义查询复用结果)，键中带索引版本号，重新加载索引后自动失效
+        self.index_version = 0
+        self.cache_size = 1024
+        self.semantic_cache_size = 256
+        self.semantic_threshold = 0.97
+        self._cache_lock = threading.Lock()
+        self._exact_cache = OrderedDict()
+        self._semantic_embs = None # [N, d]，已归一化的查询向量
+        self._semantic_entries = [] # 与 _semantic_embs 逐行对应的 (参数键, 结果)
         
         # 加载所有组件
         self._initialize_components()
     
     def _initialize_components(self):
         """初始化所有组件"""
-        print("正在初始化混合搜索引擎组件...")
+        logger.info("正在初始化混合搜索引擎组件...")
         
         # 1. 加载嵌入模型
-        print("  加载嵌入模型...")
+        logger.info("  加载嵌入模型...")
         try:
-            self.embedding_model = SentenceTransformer(
-                self.embedding_model_name,
-                device='cpu'
-            )
-            print(f"    嵌入模型加载成功: {self.embedding_model_name}")
+            self.embedding_model = self._load_embedding_model()
+            logger.info("    嵌入模型加载成功: %s (%s)", self.embedding_model_name, self.embedding_backend)
         except Exception as e:
-            print(f"    加载嵌入模型失败: {e}")
+            logger.error("    加载嵌入模型失败: %s", e)
             raise
         
-        # 2. 连接ChromaDB
-        print("  连接ChromaDB...")
-        try:
-            self.chroma_client = chromadb.PersistentClient(
-                path=self.chroma_db_path,
-                settings=Settings(anonymized_telemetry=False)
-            )
-            self.collection = self.chroma_client.get_collection("forum_posts")
-            print(f"    ChromaDB连接成功，文档数: {self.collection.count()}")
-        except Exception as e:
-            print(f"    连接ChromaDB失败: {e}")
-            raise
+        # 2. 加载向量索引：优先用内存 HNSW 索引，不可用时连接ChromaDB
+        if self.vector_backend == "hnswlib":
+            logger.info("  加载HNSW索引...")
+            try:
+                self._load_hnsw_index()
+                logger.info("    HNSW索引加载成功，文档数: %d", len(self.hnsw_ids))
+            except Exception as e:
+                logger.warning("    HNSW索引不可用，回退到ChromaDB: %s", e)
+                self.vector_backend = "chroma"
+        
+        if self.vector_backend != "hnswlib":
+            logger.info("  连接ChromaDB...")
+            try:
+                self.chroma_client = chromadb.PersistentClient(
+                    path=self.chroma_db_path,
+                    settings=Settings(anonymized_telemetry=False)
+                )
+                # 查询向量由本服务的模型生成，不挂 Chroma 默认的嵌入函数
+                self.collection = self.chroma_client.get_collection("forum_posts", embedding_function=None)
+                logger.info("    ChromaDB连接成功，文档数: %d", self.collection.count())
+            except Exception as e:
+                logger.error("    连接ChromaDB失败: %s", e)
+                raise
         
         # 3. 加载BM25索引
-        print("  加载BM25索引...")
+        logger.info("  加载BM25索引...")
         try:
-            if not os.path.exists(self.bm25_index_path):
-                print(f"    BM25索引文件不存在: {self.bm25_index_path}")
-                print("    请先运行 build_index.py 构建索引")
+            legacy_path = self.bm25_index_path + ".pkl"
+            if os.path.isdir(self.bm25_index_path):
+                # 稀疏矩阵以内存映射方式加载，启动快且多进程共享页缓存
+                self.bm25_model = bm25s.BM25.load(self.bm25_index_path, mmap=True, load_corpus=True)
+                self.bm25_doc_mapping = self.bm25_model.corpus
+                self.bm25_legacy = False
+            elif os.path.exists(legacy_path):
+                # 兼容旧版 pickle 索引 ({'bm25_model', 'doc_mapping'})，打分走 get_scores
+                # (旧版模型是 rank_bm25 的 BM25Okapi，反序列化需要另行安装 rank-bm25)
+                logger.warning("    使用旧版 pickle 索引: %s (建议重新运行 build_index.py)", legacy_path)
+                with open(legacy_path, 'rb') as f:
+                    index_data = pickle.load(f)
+                self.bm25_model = index_data['bm25_model']
+                self.bm25_doc_mapping = [
+                    {**doc, 'id': str(doc.get('id', i))} if isinstance(doc, dict) else {'id': str(doc)}
+                    for i, doc in enumerate(index_data['doc_mapping'])
+                ]
+                self.bm25_legacy = True
+            else:
+                logger.error("    BM25索引文件不存在: %s", self.bm25_index_path)
+                logger.error("    请先运行 build_index.py 构建索引")
                 raise FileNotFoundError(f"BM25索引文件不存在: {self.bm25_index_path}")
             
-            with open(self.bm25_index_path, 'rb') as f:
-                index_data = pickle.load(f)
+            if not self.bm25_legacy:
+                # numba JIT 编译打分和 top-k 选择，首次调用要编译，启动时先用一个词表里的词预热
+                self.bm25_model.activate_numba_scorer()
+                warmup_token = next((t for t in self.bm25_model.vocab_dict if t), None)
+                if warmup_token is not None and len(self.bm25_doc_mapping) > 0:
+                    self.bm25_model.retrieve([[warmup_token]], k=1, backend_selection="numba", show_progress=False)
+            logger.info("    BM25索引加载成功，文档数: %d", len(self.bm25_doc_mapping))
             
-            self.bm25_model = index_data['bm25_model']
-            self.bm25_doc_mapping = index_data['doc_mapping']
-            print(f"    BM25索引加载成功，文档数: {len(self.bm25_doc_mapping)}")
+            if self.bm25_legacy and not os.path.exists(self.posts_store_path):
+                # 旧版部署没有单独的帖子库，原文就存在 doc_mapping 里，直接按 ID 建字典查阅
+                self.posts_by_id = {doc['id']: doc for doc in self.bm25_doc_mapping}
+                logger.warning("    帖子原文库不存在，使用旧版索引中的原文，帖子数: %d", len(self.posts_by_id))
+            else:
+                # doc_mapping 只存帖子ID，原文从帖子库按 ID 查阅 (内存映射，随用随读)
+                self.posts_by_id = PostStore(self.posts_store_path)
+                logger.info("    帖子原文加载成功，帖子数: %d", len(self.posts_by_id))
         except Exception as e:
-            print(f"    加载BM25索引失败: {e}")
+            logger.error("    加载BM25索引失败: %s", e)
             raise
         
-        print("所有组件初始化完成！")
+        # 索引已重新加载，旧的缓存结果全部作废
+        with self._cache_lock:
+            self.index_version += 1
+            self._exact_cache.clear()
+            self._semantic_embs = None
+            self._semantic_entries = []
+        
+        logger.info("所有组件初始化完成！")
     
-    def _vector_search(self, query: str, top_k: int = 20) -> List[Dict[str, Any]]:
+    def _load_hnsw_index(self):
+        """载入 build_index.py 导出的 hnswlib 索引及其标签 -> 帖子ID 映射"""
+        if hnswlib is None:
+            raise ImportError("未安装 hnswlib")
+        with open(self.hnsw_ids_path, 'rb') as f:
+            meta = json.loads(f.read())
+        index = hnswlib.Index(space='cosine', dim=meta['dim'])
+        index.load_index(self.hnsw_index_path)
+        self.hnsw_ids = meta['ids']
+        self.hnsw_search_ef = meta.get('search_ef', 64)
+        self.hnsw_index = index
+    
+    def _load_embedding_model(self) -> SentenceTransformer:
+        """
+        加载 INT8 动态量化的 ONNX 模型 (CPU 上借助 VNNI 指令做 int8 矩阵乘，查询编码快 2~4 倍)
+        首次启动时导出并缓存到 onnx_model_dir，失败则回退到 PyTorch
+        """
+        quantized_file = "onnx/model_qint8_avx512_vnni.onnx"
+        local_dir = os.path.join(self.onnx_model_dir, self.embedding_model_name.replace('/', '__'))
+        try:
+            if not os.path.exists(os.path.join(local_dir, quantized_file)):
+                logger.info("    首次启动，正在导出 INT8 量化 ONNX 模型...")
+                model = SentenceTransformer(self.embedding_model_name, device='cpu', backend='onnx')
+                model.save(local_dir)
+                export_dynamic_quantized_onnx_model(model, "avx512_vnni", local_dir)
+            
+            model = SentenceTransformer(
+                local_dir,
+                device='cpu',
+                backend='onnx',
+                model_kwargs={"file_name": quantized_file, "provider": "CPUExecutionProvider"}
+            )
+            self.embedding_backend = 'onnx'
+            return model
+        except Exception as e:
+            logger.warning("    INT8 ONNX 模型不可用，回退到 PyTorch: %s", e)
+        
+        # PyTorch CPU 推理：线程数设为核数 (单条查询的矩阵乘靠 intra-op 并行)，inter-op 设为 1 避免线程争抢
+        # CPU 上 fp16 没有硬件加速，保持 fp32
+        torch.set_num_threads(os.cpu_count() or 4)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # 已有并行任务启动后不允许再修改
+        model = SentenceTransformer(self.embedding_model_name, device='cpu')
+        model.eval()
+        self.embedding_backend = 'torch'
+        return model
+    
+    def _encode_query(self, query: str) -> np.ndarray:
+        """生成归一化的查询向量"""
+        if self.embedding_backend == 'torch':
+            # 推理模式：跳过 autograd 记录，减少前向过程中的内存分配
+            with torch.inference_mode():
+                return self.embedding_model.encode(
+                    query,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+        return self.embedding_model.encode(
+            query,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+    
+    def _cache_get(self, key: tuple) -> Optional[List[Dict[str, Any]]]:
+        """精确匹配缓存查找，命中时移到 LRU 队尾"""
+        with self._cache_lock:
+            results = self._exact_cache.get(key)
+            if results is not None:
+                self._exact_cache.move_to_end(key)
+        return results
+    
+    def _semantic_cache_get(self, query_embedding: np.ndarray, params: tuple) -> Optional[List[Dict[str, Any]]]:
+        """语义缓存查找：与最近的查询向量余弦相似度超过阈值且参数相同，则复用其结果"""
+        with self._cache_lock:
+            if self._semantic_embs is None:
+                return None
+            similarities = self._semantic_embs @ query_embedding
+            for i in np.argsort(similarities)[::-1]:
+                if similarities[i] <= self.semantic_threshold:
+                    break
+                cached_params, results = self._semantic_entries[i]
+                if cached_params == params:
+                    return results
+        return None
+    
+    def _cache_put(self, key: tuple, results: List[Dict[str, Any]], query_embedding: Optional[np.ndarray]):
+        """写入精确匹配缓存和语义缓存 (均按容量淘汰最旧的条目)"""
+        with self._cache_lock:
+            if key[0] != self.index_version:
+                return # 搜索期间索引已重新加载
+            self._exact_cache[key] = results
+            self._exact_cache.move_to_end(key)
+            while len(self._exact_cache) > self.cache_size:
+                self._exact_cache.popitem(last=False)
+            
+            if query_embedding is not None:
+                row = query_embedding.astype(np.float32)[None, :]
+                if self._semantic_embs is None:
+                    self._semantic_embs = row
+                else:
+                    self._semantic_embs = np.vstack([self._semantic_embs, row])[-self.semantic_cache_size:]
+                self._semantic_entries.append((key[:1] + key[2:], results))
+                self._semantic_entries = self._semantic_entries[-self.semantic_cache_size:]
+    
+    def _vector_search(self, query_embedding: np.ndarray, top_k: int = 20) -> Optional[List[Dict[str, Any]]]:
         """
         向量搜索
         
         Args:
-            query: 查询文本
+            query_embedding: 归一化的查询向量 (由 search() 统一生成，各路检索共用)
             top_k: 返回结果数量
             
         Returns:
-            搜索结果列表
+            搜索结果列表，检索出错时返回 None
         """
         try:
-            # 生成查询向量
-            query_embedding = self.embedding_model.encode(
-                query,
-                convert_to_numpy=True,
-                normalize_embeddings=True
-            ).tolist()
+            if self.hnsw_index is not None:
+                # 直接在内存 HNSW 图上检索；ef 按 top_k 放大 (并发查询互相改写 ef 只影响召回，hnswlib 内部保证 ef >= k)
+                k = min(top_k, len(self.hnsw_ids))
+                if k == 0:
+                    return []
+                self.hnsw_index.set_ef(max(self.hnsw_search_ef, 2 * top_k))
+                labels, dists = self.hnsw_index.knn_query(query_embedding, k=k, num_threads=1)
+                hnsw_ids = self.hnsw_ids
+                ids = [hnsw_ids[label] for label in labels[0].tolist()]
+                distances = dists[0].tolist()
+            else:
+                # 在ChromaDB中搜索 (只取 ID 和距离，正文等字段从帖子库按 ID 读取，不必跨边界搬运全文)
+                results = self.collection.query(
+                    query_embeddings=[query_embedding.tolist()],
+                    n_results=top_k,
+                    include=["distances"]
+                )
+                ids = results['ids'][0] if results['ids'] else []
+                distances = results['distances'][0] if ids else []
             
-            # 在ChromaDB中搜索
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k,
-                include=["documents", "metadatas", "distances"]
-            )
+            # 格式化结果 (先取出各列并绑定到局部变量，再用一次列表推导生成)
+            get_post = self.posts_by_id.get
+            posts = [get_post(doc_id) for doc_id in ids]
             
-            # 格式化结果
-            vector_results = []
-            if results['ids'] and len(results['ids'][0]) > 0:
-                for i in range(len(results['ids'][0])):
-                    doc_id = results['ids'][0][i]
-                    metadata = results['metadatas'][0][i]
-                    distance = results['distances'][0][i]
-                    document = results['documents'][0][i] if results['documents'][0] else ""
-                    
-                    # 将距离转换为相似度分数（距离越小，相似度越高）
-                    # ChromaDB使用L2距离，我们将其转换为0-1的相似度分数
-                    similarity_score = 1.0 / (1.0 + distance) if distance > 0 else 1.0
-                    
-                    vector_results.append({
-                        'id': doc_id,
-                        'title': metadata.get('title', '无标题'),
-                        'content': document,
-                        'author': metadata.get('author', '未知作者'),
-                        'url': metadata.get('url', ''),
-                        'timestamp': metadata.get('timestamp', ''),
-                        'score': similarity_score,
-                        'search_type': 'vector'
-                    })
+            # 帖子库里查不到的 ID (向量索引与帖子库不同步) 直接跳过，不返回空白结果
+            missing = [doc_id for doc_id, post in zip(ids, posts) if post is None]
+            if missing:
+                logger.warning("向量检索命中 %d 条帖子库中不存在的ID，已跳过 (请重新运行 build_index.py): %s",
+                               len(missing), missing[:5])
             
-            return vector_results
+            # 两种后端都使用余弦距离 (distance = 1 - cos)，还原为余弦相似度
+            return [
+                {
+                    'id': doc_id,
+                    'title': post.get('title', '无标题'),
+                    'content': post.get('content', ''),
+                    'author': post.get('author', '未知作者'),
+                    'url': post.get('url', ''),
+                    'timestamp': post.get('timestamp', ''),
+                    'summary': post.get('summary', ''),
+                    'score': 1.0 - distance,
+                    'search_type': 'vector'
+                }
+                for doc_id, post, distance in zip(ids, posts, distances)
+                if post is not None
+            ]
             
         except Exception as e:
-            print(f"向量搜索失败: {e}")
-            return []
+            logger.error("向量搜索失败: %s", e)
+            return None
     
-    def _keyword_search(self, query: str, top_k: int = 20) -> List[Dict[str, Any]]:
+    def _keyword_search(self, query: str, top_k: int = 20, normalize: bool = True) -> Optional[List[Dict[str, Any]]]:
         """
         关键词搜索
         
         Args:
             query: 查询文本
             top_k: 返回结果数量
+            normalize: 是否把 BM25 分数归一化到 0-1 (RRF 只用排名，可以跳过)
             
         Returns:
-            搜索结果列表
+            搜索结果列表，检索出错时返回 None
         """
         try:
-            # 对查询进行分词
-            tokenized_query = list(jieba.cut_for_search(query))
-            
-            # 过滤停用词和短词
-            filtered_tokens = []
-            for token in tokenized_query:
-                token = token.strip()
-                if len(token) > 1 and not token.isspace():
-                    filtered_tokens.append(token)
+            # 对查询进行分词 (与建索引共用同一套分词和停用词过滤)
+            filtered_tokens = tokenize(query)
             
             if not filtered_tokens:
                 return []
             
-            # 使用BM25进行搜索
-            scores = self.bm25_model.get_scores(filtered_tokens)
+            # 使用BM25进行搜索 (bm25s 预先算好每个词在每篇文档上的得分，查询只需取几列求和)
+            k = min(top_k, len(self.bm25_doc_mapping))
+            if k == 0:
+                return []
+            if self.bm25_legacy:
+                # 旧版索引只能拿到全部分数，用 argpartition 线性时间选出 top-k，再只对这 k 个排序
+                all_scores = np.asarray(self.bm25_model.get_scores(filtered_tokens))
+                top_indices = np.argpartition(all_scores, -k)[-k:]
+                top_indices = top_indices[np.argsort(all_scores[top_indices])[::-1]]
+                docs = [[self.bm25_doc_mapping[i] for i in top_indices]]
+                scores = [all_scores[top_indices]]
+            else:
+                docs, scores = self.bm25_model.retrieve(
+                    [filtered_tokens], k=k, backend_selection="numba", show_progress=False
+                )
             
-            # 获取top_k个结果的索引
-            top_indices = np.argsort(scores)[::-1][:top_k]
+            # 只保留与查询有共同词的文档 (分数 > 0)
+            doc_scores = np.asarray(scores[0], dtype=np.float64)
+            matched = doc_scores > 0
+            if not matched.any():
+                return []
+            doc_scores = doc_scores[matched]
+            hit_docs = [doc for doc, ok in zip(docs[0], matched) if ok]
             
-            # 格式化结果
-            keyword_results = []
-            for idx in top_indices:
-                if idx < len(self.bm25_doc_mapping):
-                    doc_info = self.bm25_doc_mapping[idx]
-                    score = scores[idx]
-                    
-                    # BM25分数可能为负数，我们将其归一化到0-1范围
-                    normalized_score = max(0.0, min(1.0, (score + 2) / 4))  # 简单归一化
-                    
-                    keyword_results.append({
-                        'id': doc_info.get('id', str(idx)),
-                        'title': doc_info.get('title', '无标题'),
-                        'content': doc_info.get('content', ''),
-                        'author': doc_info.get('author', '未知作者'),
-                        'url': doc_info.get('url', ''),
-                        'timestamp': doc_info.get('timestamp', ''),
-                        'score': normalized_score,
-                        'search_type': 'keyword'
-                    })
+            # BM25 分数没有固定范围，需要与向量分数相加时在返回的窗口内做 min-max 归一化到 0-1
+            if normalize:
+                low, high = doc_scores.min(), doc_scores.max()
+                doc_scores = (doc_scores - low) / (high - low) if high > low else np.ones_like(doc_scores)
             
-            return keyword_results
+            # 格式化结果 (帖子库里查不到的 ID 直接跳过，不返回空白结果)
+            get_post = self.posts_by_id.get
+            posts = [get_post(doc['id']) for doc in hit_docs]
+            missing = [doc['id'] for doc, post in zip(hit_docs, posts) if post is None]
+            if missing:
+                logger.warning("关键词检索命中 %d 条帖子库中不存在的ID，已跳过 (请重新运行 build_index.py): %s",
+                               len(missing), missing[:5])
+            return [
+                {
+                    'id': doc['id'],
+                    'title': post.get('title', '无标题'),
+                    'content': post.get('content', ''),
+                    'author': post.get('author', '未知作者'),
+                    'url': post.get('url', ''),
+                    'timestamp': post.get('timestamp', ''),
+                    'summary': post.get('summary', ''),
+                    'score': score,
+                    'search_type': 'keyword'
+                }
+                for doc, post, score in zip(hit_docs, posts, doc_scores.tolist())
+                if post is not None
+            ]
             
         except Exception as e:
-            print(f"关键词搜索失败: {e}")
-            return []
+            logger.error("关键词搜索失败: %s", e)
+            return None
     
     def _rrf_fusion(self, vector_results: List[Dict], keyword_results: List[Dict], 
                    top_k: int = 20, k: int = 60) -> List[Dict[str, Any]]:
@@ -263,105 +498,109 @@ class HybridSearchEngine:
         Returns:
             融合后的结果列表
         """
-        # 创建文档ID到排名的映射
-        vector_ranks = {}
-        keyword_ranks = {}
+        # 文档ID -> (排名, 结果)，一次遍历建好，后续 O(1) 查找
+        vector_map = {result['id']: (rank, result) for rank, result in enumerate(vector_results, 1)}
+        keyword_map = {result['id']: (rank, result) for rank, result in enumerate(keyword_results, 1)}
+        
+        # 收集所有唯一的文档ID (先向量结果，后关键词结果)
+        all_doc_ids = list(vector_map)
+        all_doc_ids.extend(doc_id for doc_id in keyword_map if doc_id not in vector_map)
+        if not all_doc_ids:
+            return []
         
-        # 记录向量搜索结果的排名
-        for rank, result in enumerate(vector_results, 1):
-            doc_id = result['id']
-            vector_ranks[doc_id] = rank
+        # 未出现的文档排名设为 k+1
+        missing = (k + 1, None)
+        vector_ranks = np.array([vector_map.get(doc_id, missing)[0] for doc_id in all_doc_ids], dtype=np.float64)
+        keyword_ranks = np.array([keyword_map.get(doc_id, missing)[0] for doc_id in all_doc_ids], dtype=np.float64)
         
-        # 记录关键词搜索结果的排名
-        for rank, result in enumerate(keyword_results, 1):
-            doc_id = result['id']
-            keyword_ranks[doc_id] = rank
+        # RRF公式: score = 1/(k + rank)，整体向量化计算
+        vector_scores = 1.0 / (k + vector_ranks)
+        keyword_scores = 1.0 / (k + keyword_ranks)
+        total_scores = vector_scores + keyword_scores
         
-        # 收集所有唯一的文档ID
-        all_doc_ids = set(list(vector_ranks.keys()) + list(keyword_ranks.keys()))
+        # 只对前 top_k 个做排序 (argpartition 为线性时间)
+        n = min(top_k, len(all_doc_ids))
+        if n <= 0:
+            return []
+        top = np.argpartition(-total_scores, n - 1)[:n]
+        top = top[np.argsort(-total_scores[top], kind='stable')]
         
-        # 计算每个文档的RRF分数
         rrf_scores = []
-        for doc_id in all_doc_ids:
-            vector_rank = vector_ranks.get(doc_id, k + 1)  # 如果未出现，排名设为k+1
-            keyword_rank = keyword_ranks.get(doc_id, k + 1)
-            
-            # RRF公式: score = 1/(k + rank)
-            vector_score = 1.0 / (k + vector_rank)
-            keyword_score = 1.0 / (k + keyword_rank)
-            
-            total_score = vector_score + keyword_score
-            
+        for i in top:
+            doc_id = all_doc_ids[i]
+            in_vector = doc_id in vector_map
+            in_keyword = doc_id in keyword_map
             # 获取文档信息（优先从向量结果中获取，因为包含完整内容）
-            doc_info = None
-            for result in vector_results:
-                if result['id'] == doc_id:
-                    doc_info = result
-                    break
+            doc_info = vector_map[doc_id][1] if in_vector else keyword_map[doc_id][1]
             
-            if not doc_info:
-                for result in keyword_results:
-                    if result['id'] == doc_id:
-                        doc_info = result
-                        break
-            
-            if doc_info:
-                rrf_scores.append({
-                    'id': doc_id,
-                    'title': doc_info.get('title', '无标题'),
-                    'content': doc_info.get('content', ''),
-                    'author': doc_info.get('author', '未知作者'),
-                    'url': doc_info.get('url', ''),
-                    'timestamp': doc_info.get('timestamp', ''),
-                    'score': total_score,
-                    'vector_score': vector_score,
-                    'keyword_score': keyword_score,
-                    'vector_rank': vector_rank if doc_id in vector_ranks else None,
-                    'keyword_rank': keyword_rank if doc_id in keyword_ranks else None
-                })
-        
-        # 按RRF分数降序排序
-        rrf_scores.sort(key=lambda x: x['score'], reverse=True)
-        
-        return rrf_scores[:top_k]
+            rrf_scores.append({
+                'id': doc_id,
+                'title': doc_info.get('title', '无标题'),
+                'content': doc_info.get('content', ''),
+                'author': doc_info.get('author', '未知作者'),
+                'url': doc_info.get('url', ''),
+                'timestamp': doc_info.get('timestamp', ''),
+                'summary': doc_info.get('summary', ''),
+                'score': float(total_scores[i]),
+                'vector_score': float(vector_scores[i]),
+                'keyword_score': float(keyword_scores[i]),
+                'vector_rank': vector_map[doc_id][0] if in_vector else None,
+                'keyword_rank': keyword_map[doc_id][0] if in_keyword else None
+            })
+        
+        return rrf_scores
     
-    def _create_summary(self, content: str, max_length: int = 100) -> str:
+    def _weighted_fusion(self, vector_results: List[Dict], keyword_results: List[Dict],
+                         top_k: int = 20, vector_weight: float = 0.5) -> List[Dict[str, Any]]:
         """
-        创建内容摘要
+        加权分数融合
         
         Args:
-            content: 原始内容
-            max_length: 摘要最大长度
+            vector_results: 向量搜索结果 (余弦相似度)
+            keyword_results: 关键词搜索结果 (min-max 归一化后的 BM25 分数)
+            top_k: 最终返回结果数量
+            vector_weight: 向量分数的权重，关键词分数权重为 1 - vector_weight
             
         Returns:
-            摘要文本
+            融合后的结果列表
         """
-        if not content:
-            return ""
-        
-        # 简单实现：截取前max_length个字符
-        if len(content) <= max_length:
-            return content
-        
-        # 尝试在句子边界处截断
-        sentences = content.split('。')
-        summary = ""
-        for sentence in sentences:
-            if len(summary) + len(sentence) + 1 <= max_length:
-                if summary:
-                    summary += "。" + sentence
-                else:
-                    summary = sentence
-            else:
-                break
+        vector_map = {result['id']: result for result in vector_results}
+        keyword_map = {result['id']: result for result in keyword_results}
         
-        if summary:
-            return summary + "。"
-        else:
-            # 如果无法按句子截断，直接截取
-            return content[:max_length] + "..."
+        all_doc_ids = list(vector_map)
+        all_doc_ids.extend(doc_id for doc_id in keyword_map if doc_id not in vector_map)
+        n = min(top_k, len(all_doc_ids))
+        if n <= 0:
+            return []
+        
+        # 某一路没有召回的文档，该路分数记为 0
+        vector_scores = np.array([vector_map[d]['score'] if d in vector_map else 0.0 for d in all_doc_ids])
+        keyword_scores = np.array([keyword_map[d]['score'] if d in keyword_map else 0.0 for d in all_doc_ids])
+        total_scores = vector_weight * vector_scores + (1.0 - vector_weight) * keyword_scores
+        
+        top = np.argpartition(-total_scores, n - 1)[:n]
+        top = top[np.argsort(-total_scores[top], kind='stable')]
+        
+        fused_results = []
+        for i in top:
+            doc_id = all_doc_ids[i]
+            doc_info = vector_map.get(doc_id) or keyword_map[doc_id]
+            fused_results.append({
+                'id': doc_id,
+                'title': doc_info.get('title', '无标题'),
+                'content': doc_info.get('content', ''),
+                'author': doc_info.get('author', '未知作者'),
+                'url': doc_info.get('url', ''),
+                'timestamp': doc_info.get('timestamp', ''),
+                'summary': doc_info.get('summary', ''),
+                'score': float(total_scores[i]),
+                'vector_score': float(vector_scores[i]),
+                'keyword_score': float(keyword_scores[i])
+            })
+        
+        return fused_results
     
-    def search(self, query: str, top_k: int = 20, fusion_method: str = "rrf") -> List[Dict[str, Any]]:
+    async def search(self, query: str, top_k: int = 20, fusion_method: str = "rrf") -> List[Dict[str, Any]]:
         """
         执行混合搜索
         
@@ -373,24 +612,62 @@ class HybridSearchEngine:
         Returns:
             搜索结果列表
         """
-        import time
-        start_time = time.time()
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("执行混合搜索: '%s' (top_k=%d, fusion=%s)", query, top_k, fusion_method)
+        
+        # 0. 查询缓存：先查精确匹配，再用查询向量查语义缓存
+        cache_key = (self.index_version, query, top_k, fusion_method)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.debug("  命中查询缓存")
+            return [dict(result) for result in cached]
+        
+        # 关键词搜索不依赖查询向量，先放到线程里跑，与查询编码重叠
+        keyword_task = asyncio.ensure_future(
+            asyncio.to_thread(self._keyword_search, query, top_k * 2, fusion_method != "rrf")
+        )
         
-        print(f"执行混合搜索: '{query}' (top_k={top_k}, fusion={fusion_method})")
+        try:
+            query_embedding = await asyncio.to_thread(self._encode_query, query)
+        except Exception as e:
+            logger.error("生成查询向量失败: %s", e)
+            query_embedding = None
+        
+        if query_embedding is not None:
+            cached = self._semantic_cache_get(query_embedding, (self.index_version, top_k, fusion_method))
+            if cached is not None:
+                logger.debug("  命中语义缓存")
+                # 丢弃关键词搜索：尚在线程池排队的直接取消，已在执行的结果不再使用
+                keyword_task.cancel()
+                self._cache_put(cache_key, cached, None)
+                return [dict(result) for result in cached]
+        
+        # 1. 并行执行向量搜索和关键词搜索 (查询向量只生成一次；ChromaDB/hnswlib 检索和 numba 打分都会释放 GIL)
+        if query_embedding is not None:
+            vector_results, keyword_results = await asyncio.gather(
+                asyncio.to_thread(self._vector_search, query_embedding, top_k * 2),  # 获取更多结果用于融合
+                keyword_task
+            )
+        else:
+            # 查询编码失败时只用关键词结果
+            vector_results, keyword_results = None, await keyword_task
         
-        # 1. 并行执行向量搜索和关键词搜索
-        vector_results = self._vector_search(query, top_k=top_k * 2)  # 获取更多结果用于融合
-        keyword_results = self._keyword_search(query, top_k=top_k * 2)
+        # 查询编码或某一路检索失败时用剩下的结果继续融合，但这种不完整的结果不能写入缓存
+        degraded = vector_results is None or keyword_results is None
+        vector_results = vector_results or []
+        keyword_results = keyword_results or []
         
-        print(f"  向量搜索结果: {len(vector_results)} 条")
-        print(f"  关键词搜索结果: {len(keyword_results)} 条")
+        if debug:
+            logger.debug("  向量搜索结果: %d 条", len(vector_results))
+            logger.debug("  关键词搜索结果: %d 条", len(keyword_results))
         
         # 2. 结果融合
         if fusion_method == "rrf":
             fused_results = self._rrf_fusion(vector_results, keyword_results, top_k=top_k)
         elif fusion_method == "weighted":
-            # 加权融合（简单实现：各占50%）
-            fused_results = self._rrf_fusion(vector_results, keyword_results, top_k=top_k)
+            # 加权融合：两路分数都已在 0-1 范围内，按权重相加
+            fused_results = self._weighted_fusion(vector_results, keyword_results, top_k=top_k)
         else:  # simple
             # 简单合并，优先向量结果
             all_results = {}
@@ -405,22 +682,26 @@ class HybridSearchEngine:
             fused_results.sort(key=lambda x: x.get('score', 0), reverse=True)
             fused_results = fused_results[:top_k]
         
-        # 3. 添加摘要
+        # 3. 摘要已在建索引时生成，旧索引没有摘要时退回截取正文开头
         for result in fused_results:
-            result['summary'] = self._create_summary(result.get('content', ''))
+            result['summary'] = result.get('summary') or result.get('content', '')[:100]
         
-        # 4. 计算搜索时间
-        search_time_ms = (time.time() - start_time) * 1000
-        print(f"  搜索完成，返回 {len(fused_results)} 条结果，耗时 {search_time_ms:.2f}ms")
+        if debug:
+            logger.debug("  搜索完成，返回 %d 条结果", len(fused_results))
         
-        return fused_results
+        if degraded:
+            logger.warning("  检索未完整执行，本次结果不写入缓存")
+        else:
+            self._cache_put(cache_key, fused_results, query_embedding)
+        return [dict(result) for result in fused_results]
 
 
 # 创建FastAPI应用
 app = FastAPI(
     title="校园论坛混合搜索引擎API",
     description="基于向量检索和关键词检索的混合搜索引擎，支持RRF融合",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # 添加CORS中间件
@@ -442,9 +723,9 @@ async def startup_event():
     global search_engine
     try:
         search_engine = HybridSearchEngine()
-        print("搜索引擎初始化成功，API服务已就绪")
+        logger.info("搜索引擎初始化成功，API服务已就绪")
     except Exception as e:
-        print(f"搜索引擎初始化失败: {e}")
+        logger.error("搜索引擎初始化失败: %s", e)
         raise
 
 
@@ -480,42 +761,30 @@ async def search(request: SearchRequest):
     if not request.query or not request.query.strip():
         raise HTTPException(status_code=400, detail="查询文本不能为空")
     
-    import time
-    start_time = time.time()
+    # 只在接口边界计时一次；perf_counter 单调且开销比 time.time() 小
+    t0 = time.perf_counter()
     
     try:
         # 执行搜索
-        results = search_engine.search(
+        results = await search_engine.search(
             query=request.query,
             top_k=request.top_k,
             fusion_method=request.fusion_method
         )
         
-        # 转换为响应模型
-        search_results = []
-        for result in results:
-            search_results.append(SearchResult(
-                id=result['id'],
-                title=result['title'],
-                content=result['content'],
-                author=result['author'],
-                url=result['url'],
-                timestamp=result['timestamp'],
-                score=result['score'],
-                summary=result.get('summary', '')
-            ))
-        
-        search_time_ms = (time.time() - start_time) * 1000
-        
-        return SearchResponse(
-            query=request.query,
-            total_results=len(search_results),
-            results=search_results,
-            search_time_ms=search_time_ms
-        )
+        search_time_ms = (time.perf_counter() - t0) * 1000
+        
+        # 整棵响应树交给 pydantic-core 一次校验，不再逐条构造 SearchResult
+        response = SearchResponse.model_validate({
+            'query': request.query,
+            'total_results': len(results),
+            'results': results,
+            'search_time_ms': search_time_ms
+        })
+        return ORJSONResponse(response.model_dump())
         
     except Exception as e:
-        print(f"搜索过程中发生错误: {e}")
+        logger.exception("搜索过程中发生错误: %s", e)
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
 
@@ -526,6 +795,7 @@ async def health_check():
         return {
             "status": "healthy",
             "engine_initialized": True,
+            "vector_backend": search_engine.vector_backend,
             "chromadb_connected": search_engine.collection is not None,
             "bm25_loaded": search_engine.bm25_model is not None
         }
@@ -545,9 +815,12 @@ async def get_stats():
     
     try:
         chroma_count = search_engine.collection.count() if search_engine.collection else 0
+        hnsw_count = len(search_engine.hnsw_ids) if search_engine.hnsw_ids else 0
         bm25_count = len(search_engine.bm25_doc_mapping) if search_engine.bm25_doc_mapping else 0
         
         return {
+            "vector_backend": search_engine.vector_backend,
+            "hnsw_document_count": hnsw_count,
             "chromadb_document_count": chroma_count,
             "bm25_document_count": bm25_count,
             "embedding_model": search_engine.embedding_model_name,
@@ -572,7 +845,8 @@ def main():
         app,
         host="0.0.0.0",
         port=8000,
-        reload=False  # 生产环境设为False
+        reload=False,  # 生产环境设为False
+        log_level="warning"  # 不输出逐条请求的访问日志
     )
 
 
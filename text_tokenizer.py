@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分词模块
+功能：jieba 分词 + 过滤，以及按 帖子ID + 内容哈希 缓存分词结果，
+重建索引时未变化的帖子直接复用，不再重复分词；另提供建索引时共用的摘要生成
+"""
+
+import io
+import os
+import hashlib
+import multiprocessing
+from typing import List, Dict, Any, Tuple
+
+try:
+    # jieba_fast 是 jieba 的 C 扩展实现，分词结果一致，未安装时回退到纯 Python 的 jieba
+    import jieba_fast as jieba
+except ImportError:
+    import jieba
+import orjson
+import zstandard
+from tqdm import tqdm
+
+# 分词缓存文件：首行为 {"fp": 分词规则指纹, "vocab": [...]}，其余每行 {"id": 帖子ID, "h": 内容哈希, "t": [词ID, ...]}
+TOKENS_CACHE_PATH = "data/tokens.jsonl.zst"
+
+# 停用词表 (单字词会被长度过滤掉，表中只需收录多字词)
+STOPWORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwords.txt")
+
+
+def _load_stopwords(path: str = STOPWORDS_PATH) -> frozenset:
+    if not os.path.exists(path):
+        print(f"⚠️ 停用词表不存在: {path}")
+        return frozenset()
+    with open(path, 'r', encoding='utf-8') as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+STOPWORDS = _load_stopwords()
+
+
+def content_hash(text: str) -> str:
+    """文本内容指纹，用于判断帖子是否变化"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def post_text(post: Dict[str, Any]) -> str:
+    """组合标题和内容，作为关键词检索的文档"""
+    return f"{post.get('title', '')} {post.get('content', '')}"
+
+
+# 分词规则指纹：分词器或停用词表变了，旧的分词缓存随之作废
+TOKENIZER_FINGERPRINT = content_hash(jieba.__name__ + "\n" + "\n".join(sorted(STOPWORDS)))
+
+
+def create_summary(content: str, max_length: int = 100) -> str:
+    """
+    创建内容摘要 (建索引时生成一次，检索时直接读取)
+    
+    Args:
+        content: 原始内容
+        max_length: 摘要最大长度
+        
+    Returns:
+        摘要文本
+    """
+    if not content:
+        return ""
+    
+    # 简单实现：截取前max_length个字符
+    if len(content) <= max_length:
+        return content
+    
+    # 尝试在句子边界处截断
+    sentences = content.split('。')
+    summary = ""
+    for sentence in sentences:
+        if len(summary) + len(sentence) + 1 <= max_length:
+            if summary:
+                summary += "。" + sentence
+            else:
+                summary = sentence
+        else:
+            break
+    
+    if summary:
+        return summary + "。"
+    else:
+        # 如果无法按句子截断，直接截取
+        return content[:max_length] + "..."
+
+
+def tokenize(text: str) -> List[str]:
+    """jieba 搜索引擎模式分词，过滤单字、空白和停用词"""
+    return [t for t in jieba.lcut_for_search(text) if len(t) > 1 and not t.isspace() and t not in STOPWORDS]
+
+
+def initialize():
+    """预加载 jieba 词典，避免第一次分词时才构建前缀词典"""
+    jieba.initialize()
+
+
+def _tokenize_post(post: Dict[str, Any]) -> List[str]:
+    """对单条帖子分词 (供多进程池调用，需定义在模块顶层)"""
+    return tokenize(post_text(post))
+
+
+def load_token_cache(path: str = TOKENS_CACHE_PATH) -> Dict[str, Tuple[str, List[str]]]:
+    """读取分词缓存，返回 {帖子ID: (内容哈希, 词列表)}"""
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        cache = {}
+        with open(path, 'rb') as fh:
+            reader = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fh))
+            header = orjson.loads(reader.readline())
+            if header.get('fp') != TOKENIZER_FINGERPRINT:
+                print("⚠️ 分词规则已变化，将重新分词")
+                return {}
+            vocab = header['vocab']
+            for line in reader:
+                entry = orjson.loads(line)
+                cache[entry['id']] = (entry['h'], [vocab[i] for i in entry['t']])
+        return cache
+    except Exception as e:
+        print(f"⚠️ 读取分词缓存失败，将重新分词: {e}")
+        return {}
+
+
+def save_token_cache(post_ids: List[str], hashes: List[str], token_ids: List[List[int]],
+                     vocab: Dict[str, int], path: str = TOKENS_CACHE_PATH):
+    """保存分词缓存 (词以整数 ID 存储，zstd 压缩)"""
+    vocab_list = [None] * len(vocab)
+    for token, idx in vocab.items():
+        vocab_list[idx] = token
+
+    # 先写临时文件再替换，避免中途失败留下损坏的缓存
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as fh:
+        with zstandard.ZstdCompressor(level=3).stream_writer(fh) as writer:
+            writer.write(orjson.dumps({'fp': TOKENIZER_FINGERPRINT, 'vocab': vocab_list}) + b'\n')
+            for pid, h, ids in zip(post_ids, hashes, token_ids):
+                writer.write(orjson.dumps({'id': pid, 'h': h, 't': ids}) + b'\n')
+    os.replace(tmp_path, path)
+
+
+def tokenize_corpus(posts: List[Dict[str, Any]], post_ids: List[str],
+                    cache_path: str = TOKENS_CACHE_PATH) -> Tuple[List[List[int]], Dict[str, int]]:
+    """
+    对整个语料分词，命中缓存的帖子跳过 jieba
+
+    Returns:
+        (每篇文档的词ID列表, 词表 {词: 词ID})，可直接组成 bm25s 的 Tokenized 输入
+    """
+    hashes = [content_hash(post_text(post)) for post in posts]
+    cache = load_token_cache(cache_path)
+
+    corpus_tokens: List[List[str]] = [None] * len(posts)
+    todo = []
+    for i, (pid, h) in enumerate(zip(post_ids, hashes)):
+        cached = cache.get(pid)
+        if cached is not None and cached[0] == h:
+            corpus_tokens[i] = cached[1]
+        else:
+            todo.append(i)
+    del cache
+    print(f"♻️ 复用分词缓存 {len(posts) - len(todo)} 条，需分词 {len(todo)} 条")
+
+    if todo:
+        # 父进程预加载词典，fork 出的子进程直接继承，无需各自重新构建
+        initialize()
+
+        # 分词是 CPU 密集且互相独立的，按核数多进程并行
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            results = pool.imap(_tokenize_post, [posts[i] for i in todo], chunksize=256)
+            for i, tokens in zip(todo, tqdm(results, total=len(todo), desc="分词进度")):
+                corpus_tokens[i] = tokens
+
+    # 词 -> 整数 ID，bm25s 可直接用 ID 建索引，缓存也只需存整数
+    vocab: Dict[str, int] = {}
+    token_ids = [[vocab.setdefault(t, len(vocab)) for t in tokens] for tokens in corpus_tokens]
+
+    save_token_cache(post_ids, hashes, token_ids, vocab, cache_path)
+    return token_ids, vocab